@@ -1,30 +1,36 @@
 import os
 import logging
 import json
-from PIL import Image, ImageDraw
+import re
+from PIL import Image
+import numpy as np
 
 # Set up logging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+_PEAK_RE = re.compile(r"Peaks at indices: \[([^\]]*)\]")
+
 
 def read_shift_from_json(json_path):
-    logging.info(f"Reading shift value from {json_path}")
+    logging.info("Reading shift value from %s", json_path)
     with open(json_path, "r") as f:
         data = json.load(f)
     num_keys = len(data)
     shift = num_keys // 2
-    logging.info(f"Calculated shift value: {shift}")
+    logging.info("Calculated shift value: %s", shift)
     return shift
 
 
 def overlay_peaks_on_images(input_folder, output_base_folder, json_path):
     slice_files = sorted(
         [
-            f
-            for f in os.listdir(input_folder)
-            if f.startswith("slice_") and f.endswith(".bmp")
+            entry.name
+            for entry in os.scandir(input_folder)
+            if entry.is_file()
+            and entry.name.startswith("slice_")
+            and entry.name.endswith(".bmp")
         ]
     )
     shift = read_shift_from_json(json_path)
@@ -39,46 +45,45 @@ def overlay_peaks_on_images(input_folder, output_base_folder, json_path):
         # Find the image file in the input folder
         slice_path = os.path.join(input_folder, slice_file)
 
-        # Read peaks.txt to get the peak indices
+        # Read peaks.json (or peaks.txt from older runs) to get the peak indices
+        peaks_json_path = os.path.join(slice_folder_path, "peaks.json")
         peaks_file_path = os.path.join(slice_folder_path, "peaks.txt")
-        if not os.path.exists(peaks_file_path):
-            logging.warning(f"Peaks file not found: {peaks_file_path}")
+        if os.path.exists(peaks_json_path):
+            peaks_file_path = peaks_json_path
+            with open(peaks_json_path, "r") as peaks_file:
+                peak_indices = json.load(peaks_file)["peaks"]
+        elif os.path.exists(peaks_file_path):
+            with open(peaks_file_path, "r") as peaks_file:
+                match = _PEAK_RE.search(peaks_file.read())
+            peak_indices = (
+                [int(x) for x in match.group(1).split(",") if x.strip()]
+                if match
+                else []
+            )
+        else:
+            logging.warning("Peaks file not found: %s", peaks_json_path)
             continue
 
-        with open(peaks_file_path, "r") as peaks_file:
-            lines = peaks_file.readlines()
-            peak_indices = []
-            for line in lines:
-                if line.startswith("Peaks at indices"):
-                    peak_indices = [
-                        int(x) for x in line.split(": ")[1].strip("[]\n").split(", ")
-                    ]
-                    break
-
         if len(peak_indices) < 2:
-            logging.warning(f"Not enough peaks found in {peaks_file_path}")
+            logging.warning("Not enough peaks found in %s", peaks_file_path)
             continue
 
         logging.info(
-            f"Overlaying peaks for {slice_file}: {peak_indices} with shift {shift}"
+            "Overlaying peaks for %s: %s with shift %s", slice_file, peak_indices, shift
         )
 
         # Overlay peak indices on the image
         with Image.open(slice_path) as img:
-            draw = ImageDraw.Draw(img)
-            width, height = img.size
-            for peak in peak_indices:
-                shifted_peak = peak + shift
-                if 0 <= shifted_peak < width:
-                    draw.line(
-                        (shifted_peak, 0, shifted_peak, height), fill="red", width=1
-                    )
-
-            overlay_image_path = os.path.join(
-                slice_folder_path, f"overlay_{slice_file}"
-            )
-            img.save(overlay_image_path)
-            logging.info(f"Saved overlay image to {overlay_image_path}")
+            img_array = np.array(img.convert("RGB"))
+        width = img_array.shape[1]
+        shifted_peaks = [
+            peak + shift for peak in peak_indices if 0 <= peak + shift < width
+        ]
+        img_array[:, shifted_peaks] = (255, 0, 0)
+
+        overlay_image_path = os.path.join(slice_folder_path, f"overlay_{slice_file}")
+        Image.fromarray(img_array).save(overlay_image_path)
+        logging.info("Saved overlay image to %s", overlay_image_path)
 
 
 def main():
@@ -1,11 +1,11 @@
+import argparse
 import os
 import logging
 import csv
+import json
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.ndimage import gaussian_filter1d
 from scipy.signal import find_peaks
-from statistics import stdev
 
 # Set up logging
 logging.basicConfig(
@@ -13,8 +13,53 @@ logging.basicConfig(
 )
 
 
+def _gaussian_kernel1d(sigma, truncate=4.0):
+    # Same kernel scipy.ndimage.gaussian_filter1d builds on every call
+    radius = int(truncate * float(sigma) + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 / sigma**2 * x**2)
+    return kernel / kernel.sum()
+
+
+_GAUSSIAN_KERNEL = _gaussian_kernel1d(sigma=2)
+
+
+def _smooth(values):
+    # Equivalent to gaussian_filter1d(values, sigma=2), whose default "reflect"
+    # boundary is numpy's "symmetric" padding
+    radius = len(_GAUSSIAN_KERNEL) // 2
+    padded = np.pad(np.asarray(values, dtype=np.float64), radius, mode="symmetric")
+    return np.convolve(padded, _GAUSSIAN_KERNEL, mode="valid")
+
+
+_CORRELATION_RESULT_RE = r"Correlation Result \d+: (\S+)"
+
+_figure_and_axes = None
+
+
+def _get_figure_and_axes():
+    # One figure for the whole run, cleared before each combined chart
+    global _figure_and_axes
+    if _figure_and_axes is None:
+        _figure_and_axes = plt.subplots(figsize=(10, 5))
+    return _figure_and_axes
+
+
 def read_correlation_results(file_path):
-    logging.info(f"Reading correlation results from {file_path}")
+    npy_path = os.path.splitext(file_path)[0] + ".npy"
+    if os.path.exists(npy_path):
+        logging.info("Reading correlation results from %s", npy_path)
+        return np.load(npy_path)
+
+    logging.info("Reading correlation results from %s", file_path)
+    try:
+        results = np.fromregex(
+            file_path, _CORRELATION_RESULT_RE, dtype=[("value", "f8")]
+        )
+        return results["value"]
+    except ValueError:
+        logging.warning("Falling back to line-by-line parsing of %s", file_path)
+
     correlation_results = []
     with open(file_path, "r") as f:
         lines = f.readlines()
@@ -25,56 +70,53 @@ def read_correlation_results(file_path):
                     correlation_results.append(result)
                 except (IndexError, ValueError) as e:
                     logging.warning(
-                        f"Skipping line due to format error: {line.strip()}"
+                        "Skipping line due to format error: %s", line.strip()
                     )
     return correlation_results
 
 
 def find_peaks_in_correlation(correlation_results):
     # Apply Gaussian smoothing
-    smoothed = gaussian_filter1d(correlation_results, sigma=2)
+    smoothed = _smooth(correlation_results)
 
     # Find peaks
     peaks, _ = find_peaks(smoothed)
 
-    # Sort peaks by their heights in descending order
-    sorted_peaks = sorted(peaks, key=lambda x: smoothed[x], reverse=True)
-
-    if len(sorted_peaks) > 2:
-        return sorted(sorted_peaks[:2]), f"More than 2 peaks found: {sorted_peaks}"
-    elif len(sorted_peaks) < 2:
-        return sorted_peaks, "Less than 2 peaks found."
+    if len(peaks) > 2:
+        # Keep the two highest peaks without sorting all of them
+        top_two = peaks[np.argpartition(smoothed[peaks], -2)[-2:]]
+        return sorted(top_two.tolist()), f"More than 2 peaks found: {peaks.tolist()}"
+    elif len(peaks) < 2:
+        return peaks.tolist(), "Less than 2 peaks found."
     else:
-        return sorted(sorted_peaks), "Two peaks found."
+        return peaks.tolist(), "Two peaks found."
 
 
 def plot_combined_chart(correlation_results, peaks, output_image_path):
-    smoothed = gaussian_filter1d(correlation_results, sigma=2)
+    smoothed = _smooth(correlation_results)
 
-    plt.figure(figsize=(10, 5))
-    plt.plot(smoothed, label="Correlation Results", linestyle="--")
-    plt.scatter(peaks, [smoothed[p] for p in peaks], color="red", zorder=5)
+    fig, ax = _get_figure_and_axes()
+    ax.cla()
+    ax.plot(smoothed, label="Correlation Results", linestyle="--")
+    ax.scatter(peaks, [smoothed[p] for p in peaks], color="red", zorder=5)
     for peak in peaks:
-        plt.annotate(
+        ax.annotate(
             f"Peak {peak}",
             xy=(peak, smoothed[peak]),
             xytext=(peak, smoothed[peak] + 10),
             arrowprops=dict(facecolor="black", shrink=0.05),
         )
-    plt.xlabel("Index")
-    plt.ylabel("Correlation Result")
-    plt.title("Correlation Results with Peaks")
-    plt.legend()
-    plt.savefig(output_image_path)
-    logging.info(f"Combined plot saved to {output_image_path}")
-    plt.close()
+    ax.set_xlabel("Index")
+    ax.set_ylabel("Correlation Result")
+    ax.set_title("Correlation Results with Peaks")
+    ax.legend()
+    fig.savefig(output_image_path)
+    logging.info("Combined plot saved to %s", output_image_path)
 
 
-def process_correlation_results(output_base_folder):
+def process_correlation_results(output_base_folder, plots=False):
     slice_folders = [
-        os.path.join(output_base_folder, folder)
-        for folder in os.listdir(output_base_folder)
-        if os.path.isdir(os.path.join(output_base_folder, folder))
+        entry.path for entry in os.scandir(output_base_folder) if entry.is_dir()
     ]
 
     peak_indices_1 = []
@@ -87,7 +129,7 @@ def process_correlation_results(output_base_folder):
     for slice_folder in slice_folders:
         correlation_results_path = os.path.join(slice_folder, "correlation_results.txt")
         if not os.path.exists(correlation_results_path):
-            logging.warning(f"File not found: {correlation_results_path}")
+            logging.warning("File not found: %s", correlation_results_path)
             continue
 
         correlation_results = read_correlation_results(correlation_results_path)
@@ -122,9 +164,14 @@ def process_correlation_results(output_base_folder):
             f.write(f"Peaks at indices: {peaks}\n")
             f.write(f"Message: {message}\n")
 
+        peaks_json_path = os.path.join(slice_folder, "peaks.json")
+        with open(peaks_json_path, "w") as f:
+            json.dump({"peaks": [int(p) for p in peaks]}, f)
+
         # Plot combined chart
-        combined_plot_path = os.path.join(slice_folder, "combined_plot.png")
-        plot_combined_chart(correlation_results, peaks, combined_plot_path)
+        if plots:
+            combined_plot_path = os.path.join(slice_folder, "combined_plot.png")
+            plot_combined_chart(correlation_results, peaks, combined_plot_path)
 
     # Sort table rows by slice index
     table_rows.sort(key=lambda x: x[0])
@@ -140,10 +187,12 @@ def process_correlation_results(output_base_folder):
             csvwriter.writerow(row)
 
         if peak_values_1 and peak_values_2:
-            value_stdev_1 = stdev(peak_values_1)
-            value_stdev_2 = stdev(peak_values_2)
-            index_stdev_1 = stdev(peak_indices_1)
-            index_stdev_2 = stdev(peak_indices_2)
+            peak_data = np.column_stack(
+                [peak_values_1, peak_indices_1, peak_values_2, peak_indices_2]
+            )
+            value_stdev_1, index_stdev_1, value_stdev_2, index_stdev_2 = peak_data.std(
+                axis=0, ddof=1
+            )
             csvwriter.writerow([])
             csvwriter.writerow(["Statistics"])
             csvwriter.writerow(["Standard Deviation of P1 Values", value_stdev_1])
@@ -155,8 +204,19 @@ def process_correlation_results(output_base_folder):
 
 
 def main():
+    parser = argparse.ArgumentParser(
+        description="Find peaks in the correlation results of processed slices."
+    )
+    parser.add_argument(
+        "--plots",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Save a combined correlation and peaks plot for each slice.",
+    )
+
+    args = parser.parse_args()
     output_folder = "output_slices"
-    process_correlation_results(output_folder)
+    process_correlation_results(output_folder, args.plots)
 
 
 if __name__ == "__main__":
@@ -2,11 +2,17 @@ import argparse
 import logging
 import os
 import json
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from PIL import Image
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.ndimage import gaussian_filter1d
-from scipy.signal import find_peaks
+from scipy.signal import fftconvolve, find_peaks
+
+try:
+    import numba
+except ImportError:  # Numba is optional; fall back to the NumPy implementation
+    numba = None
 
 # Set up logging
 logging.basicConfig(
@@ -14,17 +20,34 @@ logging.basicConfig(
 )
 
 
-def process_image(image_path):
-    logging.info(f"Processing image {image_path}")
-    img = Image.open(image_path).convert("L")  # Convert image to grayscale
-    img_array = np.array(img)
-    height, width = img_array.shape
-    column_averages = []
+def _gaussian_kernel1d(sigma, truncate=4.0):
+    # Same kernel scipy.ndimage.gaussian_filter1d builds on every call
+    radius = int(truncate * float(sigma) + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 / sigma**2 * x**2)
+    return kernel / kernel.sum()
+
+
+_GAUSSIAN_KERNEL = _gaussian_kernel1d(sigma=2)
 
-    for col in range(width):
-        col_data = img_array[:, col]
-        avg_grayscale = np.mean(col_data)
-        column_averages.append(avg_grayscale)
+
+def _smooth(values):
+    # Equivalent to gaussian_filter1d(values, sigma=2), whose default "reflect"
+    # boundary is numpy's "symmetric" padding
+    radius = len(_GAUSSIAN_KERNEL) // 2
+    padded = np.pad(np.asarray(values, dtype=np.float64), radius, mode="symmetric")
+    return np.convolve(padded, _GAUSSIAN_KERNEL, mode="valid")
+
+
+def process_image(image_path):
+    logging.info("Processing image %s", image_path)
+    with Image.open(image_path) as img:
+        # Decoders that support it (e.g. JPEG) can decode straight to grayscale
+        img.draft("L", img.size)
+        if img.mode != "L":
+            img = img.convert("L")  # Convert image to grayscale
+        img_array = np.asarray(img, dtype=np.uint8)
+    column_averages = img_array.mean(axis=0, dtype=np.float64)
 
     return column_averages
 
@@ -33,20 +56,33 @@ def save_column_averages(column_averages, output_path):
     with open(output_path, "w") as f:
         f.write("Column Average Grayscale Values\n")
         f.write("===============================\n\n")
-        for col, avg in enumerate(column_averages):
-            f.write(f"Column {col}: {avg}\n")
+        f.write(
+            "".join(f"Column {col}: {avg}\n" for col, avg in enumerate(column_averages))
+        )
+
+
+_figure_and_axes = None
+
+
+def _get_figure_and_axes():
+    # Creating and closing a figure per slice dominates the run time, so each
+    # process builds one figure lazily and clears it before every plot
+    global _figure_and_axes
+    if _figure_and_axes is None:
+        _figure_and_axes = plt.subplots(figsize=(10, 5))
+    return _figure_and_axes
 
 
 def plot_column_averages(column_averages, output_image_path):
-    plt.figure(figsize=(10, 5))
-    plt.plot(column_averages, label="Average Grayscale Value")
-    plt.xlabel("Column")
-    plt.ylabel("Average Grayscale Value")
-    plt.title("Column Average Grayscale Values")
-    plt.legend()
-    plt.savefig(output_image_path)
-    logging.info(f"Plot saved to {output_image_path}")
-    plt.close()
+    fig, ax = _get_figure_and_axes()
+    ax.cla()
+    ax.plot(column_averages, label="Average Grayscale Value")
+    ax.set_xlabel("Column")
+    ax.set_ylabel("Average Grayscale Value")
+    ax.set_title("Column Average Grayscale Values")
+    ax.legend()
+    fig.savefig(output_image_path)
+    logging.info("Plot saved to %s", output_image_path)
 
 
 def validate_and_process_json(json_path):
@@ -58,7 +94,7 @@ def validate_and_process_json(json_path):
     return data
 
 
-def save_correlation_references(data, output_path):
+def save_metadata(data, output_path):
     with open(output_path, "w") as f:
         json.dump(data, f, indent=4)
 
@@ -69,145 +105,222 @@ def calculate_averages(data):
     return correlation_average
 
 
-def calculate_correlation_results(json_data, column_averages):
-    json_values = list(json_data.values())
-    json_avg = np.mean(json_values)
-    column_avg_of_avgs = np.mean(column_averages)
+# Number of reference values from which FFT convolution, O((N + K) log(N + K)),
+# beats the direct O(N * K) sum
+_FFT_MIN_REFS = 64
 
-    correlation_results = []
-    out_of_bounds_instances = set()
-
-    for i in range(len(column_averages)):
-        correlation_result = 0
-        out_of_bounds_encountered = False
-        for j in range(len(json_values)):
-            try:
-                image_value = column_averages[i + j]
-            except IndexError:
-                image_value = 0
-                out_of_bounds_encountered = True
-            correlation_result += (json_values[j] - json_avg) * (
-                image_value - column_avg_of_avgs
-            )
-        correlation_results.append(correlation_result)
-        if out_of_bounds_encountered:
-            out_of_bounds_instances.add(i)
 
-    return correlation_results, len(out_of_bounds_instances)
+if numba is not None:
+
+    @numba.njit(parallel=True, nogil=True, cache=True)
+    def _correlate(column_values, json_values, column_avg, json_avg, out):
+        num_columns = len(column_values)
+        for i in numba.prange(num_columns):
+            correlation_result = 0.0
+            for j in range(len(json_values)):
+                if i + j < num_columns:
+                    image_value = column_values[i + j]
+                else:
+                    image_value = 0.0
+                correlation_result += (json_values[j] - json_avg) * (
+                    image_value - column_avg
+                )
+            out[i] = correlation_result
+
+
+def calculate_correlation_results(json_values, json_avg, column_averages):
+    json_values = np.asarray(json_values, dtype=np.float64)
+    column_values = np.asarray(column_averages, dtype=np.float64)
+    column_avg_of_avgs = np.mean(column_values)
+
+    num_columns = len(column_values)
+    num_refs = len(json_values)
+    if numba is not None and num_refs < _FFT_MIN_REFS:
+        correlation_results = np.empty(num_columns)
+        _correlate(
+            column_values,
+            json_values,
+            column_avg_of_avgs,
+            json_avg,
+            correlation_results,
+        )
+    else:
+        # Past the end of the image the reference is compared against 0, so pad
+        # with -mean (i.e. 0 - column_avg_of_avgs) once centered
+        padded = np.concatenate(
+            [
+                column_values - column_avg_of_avgs,
+                np.full(num_refs - 1, -column_avg_of_avgs),
+            ]
+        )
+        centered_json = json_values - json_avg
+        if num_refs >= _FFT_MIN_REFS:
+            # Cross-correlation is convolution with the reversed reference
+            correlation_results = fftconvolve(padded, centered_json[::-1], mode="valid")
+        else:
+            windows = np.lib.stride_tricks.sliding_window_view(padded, num_refs)
+            correlation_results = windows @ centered_json
+
+    # Every start index i with i + num_refs > num_columns reads past the end
+    out_of_bounds_count = min(num_refs - 1, num_columns)
+
+    return correlation_results, out_of_bounds_count
 
 
 def find_peaks_in_correlation(correlation_results):
     # Apply Gaussian smoothing
-    smoothed = gaussian_filter1d(correlation_results, sigma=2)
+    smoothed = _smooth(correlation_results)
 
     # Find peaks
     peaks, _ = find_peaks(smoothed)
 
-    # Sort peaks by their heights in descending order
-    sorted_peaks = sorted(peaks, key=lambda x: smoothed[x], reverse=True)
+    # Order peaks by their heights in descending order, only partitioning out
+    # the top two when there are more
+    heights = smoothed[peaks]
 
-    if len(sorted_peaks) > 2:
-        return sorted_peaks[:2], f"More than 2 peaks found: {sorted_peaks}"
-    elif len(sorted_peaks) < 2:
-        return sorted_peaks, "Less than 2 peaks found."
+    if len(peaks) > 2:
+        top_two = peaks[np.argpartition(heights, -2)[-2:][::-1]]
+        return top_two.tolist(), f"More than 2 peaks found: {peaks.tolist()}"
+    elif len(peaks) < 2:
+        return peaks.tolist(), "Less than 2 peaks found."
     else:
-        return sorted_peaks, "Two peaks found."
-
-
-def process_folder(folder_path, output_base_folder, json_path, num_files=None):
-    files = sorted([f for f in os.listdir(folder_path) if f.endswith(".bmp")])
-    if num_files:
-        files = files[:num_files]
-
-    correlation_data = validate_and_process_json(json_path)
-    correlation_average = calculate_averages(correlation_data)
-
-    for file in files:
-        image_path = os.path.join(folder_path, file)
-        column_averages = process_image(image_path)
-
-        slice_number = os.path.splitext(file)[0]
-        output_folder = os.path.join(output_base_folder, slice_number)
-        os.makedirs(output_folder, exist_ok=True)
-
-        output_txt_path = os.path.join(
-            output_folder, f"{slice_number}_column_averages.txt"
-        )
-        save_column_averages(column_averages, output_txt_path)
-        logging.info(f"Column averages saved to {output_txt_path}")
-
+        return peaks[np.argsort(-heights, kind="stable")].tolist(), "Two peaks found."
+
+
+def _process_one(
+    file,
+    folder_path,
+    output_base_folder,
+    correlation_data,
+    json_values,
+    correlation_average,
+    plots=False,
+    verbose=False,
+):
+    image_path = os.path.join(folder_path, file)
+    column_averages = process_image(image_path)
+
+    slice_number = os.path.splitext(file)[0]
+    output_folder = os.path.join(output_base_folder, slice_number)
+    os.makedirs(output_folder, exist_ok=True)
+
+    output_txt_path = os.path.join(output_folder, f"{slice_number}_column_averages.txt")
+    save_column_averages(column_averages, output_txt_path)
+    logging.info("Column averages saved to %s", output_txt_path)
+
+    if plots:
         output_image_path = os.path.join(
             output_folder, f"{slice_number}_column_averages.png"
         )
         plot_column_averages(column_averages, output_image_path)
 
-        correlation_output_path = os.path.join(
-            output_folder, "correlation_references.json"
-        )
-        save_correlation_references(correlation_data, correlation_output_path)
-        logging.info(f"Correlation references saved to {correlation_output_path}")
-
-        correlation_avg_output_path = os.path.join(
-            output_folder, "correlation_references_averages.txt"
-        )
-        with open(correlation_avg_output_path, "w") as f:
-            f.write(f"Correlation References Average: {correlation_average}\n")
-
-        column_avg_of_avgs = np.mean(column_averages)
-        column_avg_output_path = os.path.join(
-            output_folder, "column_averages_average.txt"
-        )
-        with open(column_avg_output_path, "w") as f:
-            f.write(f"Column Averages Average: {column_avg_of_avgs}\n")
-
-        correlation_results, out_of_bounds_count = calculate_correlation_results(
-            correlation_data, column_averages
+    column_avg_of_avgs = np.mean(column_averages)
+    metadata = {
+        "correlation_references": correlation_data,
+        "correlation_average": float(correlation_average),
+        "column_averages_average": float(column_avg_of_avgs),
+    }
+    metadata_output_path = os.path.join(output_folder, "metadata.json")
+    save_metadata(metadata, metadata_output_path)
+    logging.info("Metadata saved to %s", metadata_output_path)
+
+    correlation_results, out_of_bounds_count = calculate_correlation_results(
+        json_values, correlation_average, column_averages
+    )
+    correlation_results_output_path = os.path.join(
+        output_folder, "correlation_results.txt"
+    )
+    with open(correlation_results_output_path, "w") as f:
+        f.write("Correlation Results\n")
+        f.write("==================\n\n")
+        f.write(
+            "".join(
+                f"Correlation Result {idx}: {result}\n"
+                for idx, result in enumerate(correlation_results)
+            )
         )
-        correlation_results_output_path = os.path.join(
-            output_folder, "correlation_results.txt"
+        f.write(
+            f"\nOut of bounds instances (deduped by correlation result): {out_of_bounds_count}\n"
         )
-        with open(correlation_results_output_path, "w") as f:
-            f.write("Correlation Results\n")
-            f.write("==================\n\n")
-            for idx, result in enumerate(correlation_results):
-                f.write(f"Correlation Result {idx}: {result}\n")
-            f.write(
-                f"\nOut of bounds instances (deduped by correlation result): {out_of_bounds_count}\n"
-            )
-
-        # Find and save peaks
-        peaks, message = find_peaks_in_correlation(correlation_results)
-        peaks_output_path = os.path.join(output_folder, "peaks.txt")
-        with open(peaks_output_path, "w") as f:
-            f.write("Peaks in Correlation Results\n")
-            f.write("============================\n\n")
-            f.write(f"Peaks at indices: {peaks}\n")
-            f.write(f"Message: {message}\n")
+    np.save(
+        os.path.join(output_folder, "correlation_results.npy"),
+        np.asarray(correlation_results),
+    )
 
-        # Output one sample calculation step-by-step for verification
+    # Find and save peaks
+    peaks, message = find_peaks_in_correlation(correlation_results)
+    peaks_output_path = os.path.join(output_folder, "peaks.txt")
+    with open(peaks_output_path, "w") as f:
+        f.write("Peaks in Correlation Results\n")
+        f.write("============================\n\n")
+        f.write(f"Peaks at indices: {peaks}\n")
+        f.write(f"Message: {message}\n")
+
+    # Output one sample calculation step-by-step for verification
+    if verbose:
         sample_output_path = os.path.join(
             output_folder, "sample_correlation_calculation.txt"
         )
+        reference_values = list(correlation_data.values())
         with open(sample_output_path, "w") as f:
             f.write("Sample Correlation Calculation Step-by-Step\n")
             f.write("===========================================\n\n")
             sample_idx = 0
             sample_correlation_result = 0
-            for j in range(len(correlation_data)):
+            for j in range(len(reference_values)):
                 try:
                     image_value = column_averages[sample_idx + j]
                 except IndexError:
                     image_value = 0
-                sample_calc = (
-                    list(correlation_data.values())[j] - correlation_average
-                ) * (image_value - column_avg_of_avgs)
+                sample_calc = (reference_values[j] - correlation_average) * (
+                    image_value - column_avg_of_avgs
+                )
                 sample_correlation_result += sample_calc
                 f.write(
-                    f"Step {j}: ({list(correlation_data.values())[j]} - {correlation_average}) * ({image_value} - {column_avg_of_avgs}) = {sample_calc}\n"
+                    f"Step {j}: ({reference_values[j]} - {correlation_average}) * ({image_value} - {column_avg_of_avgs}) = {sample_calc}\n"
                 )
             f.write(f"\nTotal Sample Correlation Result: {sample_correlation_result}\n")
 
 
+def process_folder(
+    folder_path,
+    output_base_folder,
+    json_path,
+    num_files=None,
+    max_workers=None,
+    plots=False,
+    verbose=False,
+):
+    files = sorted(
+        [
+            entry.name
+            for entry in os.scandir(folder_path)
+            if entry.is_file() and entry.name.endswith(".bmp")
+        ]
+    )
+    if num_files:
+        files = files[:num_files]
+
+    correlation_data = validate_and_process_json(json_path)
+    correlation_average = calculate_averages(correlation_data)
+    # Same for every slice, so convert the reference values only once
+    json_values = np.asarray(list(correlation_data.values()), dtype=np.float64)
+
+    process_one = partial(
+        _process_one,
+        folder_path=folder_path,
+        output_base_folder=output_base_folder,
+        correlation_data=correlation_data,
+        json_values=json_values,
+        correlation_average=correlation_average,
+        plots=plots,
+        verbose=verbose,
+    )
+    # Each slice is independent, so fan them out across processes
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(process_one, files))
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Process image slices to generate column average grayscale values."
@@ -224,10 +337,32 @@ def main():
     parser.add_argument(
         "--num_files", type=int, help="Number of image files to process."
     )
+    parser.add_argument(
+        "--max_workers",
+        type=int,
+        help="Number of worker processes (defaults to the number of CPUs).",
+    )
+    parser.add_argument(
+        "--plots",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Save a column averages plot for each slice.",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Write a step-by-step sample correlation calculation for each slice.",
+    )
 
     args = parser.parse_args()
     process_folder(
-        args.input_folder, args.output_folder, args.json_path, args.num_files
+        args.input_folder,
+        args.output_folder,
+        args.json_path,
+        args.num_files,
+        args.max_workers,
+        args.plots,
+        args.verbose,
     )
 
 
@@ -1,7 +1,9 @@
 import argparse
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
+import numpy as np
 import webbrowser
 
 # Set up logging
@@ -10,35 +12,53 @@ logging.basicConfig(
 )
 
 
+def _save_slice(slice_array, slice_path, palette=None):
+    slice_img = Image.fromarray(slice_array)
+    if palette is not None:
+        slice_img.putpalette(palette)
+    slice_img.save(slice_path)
+
+
 def slice_image(input_path, height, output_folder):
-    logging.info(f"Reading image from {input_path}")
-    img = Image.open(input_path)
-    img_width, img_height = img.size
+    logging.info("Reading image from %s", input_path)
+    # Decode once; each slice is then just a view into the same array
+    with Image.open(input_path) as img:
+        img_array = np.asarray(img)
+        palette = img.getpalette() if img.mode == "P" else None
+    img_height, img_width = img_array.shape[:2]
     total_pixels = img_width * img_height
 
-    logging.info(f"Image size: {img_width}x{img_height}")
-    logging.info(f"Total pixels in the input image: {total_pixels}")
+    logging.info("Image size: %sx%s", img_width, img_height)
+    logging.info("Total pixels in the input image: %s", total_pixels)
 
-    slice_count = 0
-    for top in range(0, img_height, height):
-        if top + height > img_height:
+    tops = range(0, img_height - height + 1, height)
+    slice_pixels = img_width * height
+    with ThreadPoolExecutor() as executor:
+        futures = [
+            executor.submit(
+                _save_slice,
+                img_array[top : top + height],
+                os.path.join(output_folder, f"slice_{slice_count}.bmp"),
+                palette,
+            )
+            for slice_count, top in enumerate(tops)
+        ]
+        for slice_count, future in enumerate(futures):
+            future.result()
+            slice_path = os.path.join(output_folder, f"slice_{slice_count}.bmp")
             logging.info(
-                "Remaining part of the image is less than the specified height. Stopping slicing."
+                "Saved slice %s to %s with %s pixels",
+                slice_count,
+                slice_path,
+                slice_pixels,
             )
-            break
-
-        bottom = top + height
-        box = (0, top, img_width, bottom)
-        slice_img = img.crop(box)
-        slice_path = os.path.join(output_folder, f"slice_{slice_count}.bmp")
-        slice_img.save(slice_path)
-        slice_pixels = img_width * height
+
+    if img_height % height:
         logging.info(
-            f"Saved slice {slice_count} to {slice_path} with {slice_pixels} pixels"
+            "Remaining part of the image is less than the specified height. Stopping slicing."
         )
-        slice_count += 1
 
-    return slice_count, output_folder, total_pixels
+    return len(tops), output_folder, total_pixels
 
 
 def main():
@@ -59,7 +79,7 @@ def main():
 
     if slice_count > 0:
         first_slice_path = os.path.join(output_folder, "slice_0.bmp")
-        logging.info(f"Opening the first slice {first_slice_path}")
+        logging.info("Opening the first slice %s", first_slice_path)
         webbrowser.open(first_slice_path)
     else:
         logging.warning("No slices were created.")